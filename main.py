@@ -1,8 +1,15 @@
-import requests
-import json
+import httpx
+import asyncio
+import orjson
+import os
 import sys
 import argparse
-import time
+import random
+import re
+import hashlib
+from collections import deque
+from videos_parser import parse_playlist_page, add_videos_statistics
+from diskcache import Cache
 
 """
 Youtube api v3 docs: https://developers.google.com/youtube/v3/getting-started
@@ -13,176 +20,304 @@ Firstly we need to get channel playlist id by channel id using "channels" api re
 Since the maximum page size that api can send is 50 items (videos) we need to make
 a chain of requests and use the "nextPageToken" field to change the "pageToken" parameter
 in the url for each request ("playlistItems" api request costs 1 quota unit per request).
+
+The "playlistItems" pages have to be fetched one after another (every page gives the token of the next one),
+but the "videos" statistics request of a page doesn't depend on the next page, so it is sent
+concurrently while the next page is being fetched.
 """
 
-api_request_allow = True
 default_out_file_path = "ytb_channel_data"
 default_max_results = 50
 
+# Channel page link that contains channel id
+canonical_link_re = re.compile(r'<link[^>]+rel="canonical"[^>]+href="([^"]+)"')
+
+# Symbols that file name can not contain
+forbidden_file_name_re = re.compile(r'[\\/:*?"<>|]')
+
+# Maximum number of ids the "videos" api request accepts
+videos_statistics_batch_size = 50
+
+# Caps the number of requests in flight at the same time
+# (created by main() for each run, a semaphore is bound to the event loop it's used in)
+request_semaphore = None
+max_concurrent_requests = 64
+
+# Keep-alive connections pool size and seconds to wait for a single response
+connection_pool_size = 50
+request_timeout = 10
+
+# Attempts of a single request before giving up
+max_request_attempts = 7
+
+# On-disk cache of api responses, so re-runs on the same channel don't spend quota again
+# (seconds to keep: playlist pages (snippets) change rarely, statistics change often)
+api_cache = None
+cache_dir = ".ytb_cache"
+playlist_cache_ttl = 86400
+statistics_cache_ttl = 3600
+
+# Built once, so main() can be called several times (batch runs) without rebuilding it
+parser = argparse.ArgumentParser()
+parser.add_argument("-url", help="Channel link")
+parser.add_argument("-key", help="Your youtube api key")
+parser.add_argument("-out", help=f"Path to the out json file, default: '{default_out_file_path}.json'",
+                    default=default_out_file_path)
+parser.add_argument("-maxr", help=f"Max results per request, default: {default_max_results}, it's apis maximum",
+                    default=default_max_results)
+parser.add_argument("--no-cache", help="Don't read or write cached api responses", action="store_true")
+parser.add_argument("--clear-cache", help=f"Remove cached api responses ('{cache_dir}' folder) before parsing",
+                    action="store_true")
+
+
+class RequestFailed(Exception):
+    pass
+
+
+class MaxRetriesExceeded(RequestFailed):
+    pass
+
 
-def stubborn_request(url, sec_bet_req=2):
+class ApiError(RequestFailed):
+    pass
 
-    response = None
-    while response is None:
+
+def backoff_delay(attempt, base_delay=0.5, max_delay=60):
+    # Exponential backoff with jitter, so concurrent requests don't retry all at the same moment
+    return min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+async def stubborn_request(session, url, max_attempts=max_request_attempts):
+
+    for attempt in range(max_attempts):
+        delay = backoff_delay(attempt)
         try:
-            response = requests.get(url)
-        except requests.exceptions.HTTPError:
-            print("Http error... Retry")
-            time.sleep(sec_bet_req)
-        except requests.exceptions.ConnectionError:
+            async with request_semaphore:
+                response = await session.get(url)
+            if response.status_code != 429:
+                return response
+            print("Too many requests... Retry")
+            # Server tells how many seconds to wait before the next request
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                delay = int(retry_after)
+        except httpx.ConnectError:
             print("Connection error... Retry")
-            time.sleep(sec_bet_req)
-        except requests.exceptions.Timeout:
+        except httpx.TimeoutException:
             print("Timeout error... Retry")
-            time.sleep(sec_bet_req)
-        except requests.exceptions.RequestException:
+        except httpx.HTTPError:
             print("Request error... Retry")
-            time.sleep(sec_bet_req)
+
+        if attempt < max_attempts - 1:
+            await asyncio.sleep(delay)
+
+    raise MaxRetriesExceeded(f"request failed after {max_attempts} attempts")
+
+
+async def api_get_request(session, url):
+
+    response = await stubborn_request(session, url)
+    if response.status_code != 200:
+        raise ApiError(f"Api response error! (status code {response.status_code})")
     return response
 
 
-def api_get_request(url, exit_if_not=False):
-    global api_request_allow
+async def cached_api_get_json(session, url, ttl):
+
+    key = hashlib.sha256(url.encode()).hexdigest()
+    if api_cache is not None:
+        response_json = api_cache.get(key)
+        if response_json is not None:
+            return response_json
 
-    if api_request_allow:
-        response = stubborn_request(url)
-        if response.status_code != 200:
-            api_request_allow = False
-        else:
-            return response
+    response = await api_get_request(session, url)
 
-    if not api_request_allow:
-        print("\nApi response error!\n")
-        if exit_if_not:
-            sys.exit("exit")
-        return False
+    response_json = orjson.loads(response.content)
+    if api_cache is not None:
+        api_cache.set(key, response_json, expire=ttl)
+    return response_json
 
 
-def get_channel_id(channel_url):
+async def get_channel_id(session, channel_url):
+    # Network errors (MaxRetriesExceeded) are not parse errors, they go up to the entry point
+    response = (await stubborn_request(session, channel_url)).text
     try:
-        from bs4 import BeautifulSoup
-        response = stubborn_request(channel_url).text
-        bs = BeautifulSoup(response, 'html.parser')
-        # channel_id = bs.find(itemprop="channelId").get("content")
-        channel_id = bs.find("link", {"rel": "canonical"})['href'].split('/')[-1]
+        # <link rel="canonical" href="https://www.youtube.com/channel/<channel_id>">
+        channel_id = canonical_link_re.search(response).group(1).rsplit('/', 1)[-1]
         return channel_id
-    except:
+    except AttributeError:
         sys.exit("error: can not parse html page to find channel id")
 
 
-def fetch_channel_playlist_id(channel_url, max_results, api_key):
+async def fetch_channel_playlist_id(session, channel_url, max_results, api_key):
 
-    channel_id = get_channel_id(channel_url)
+    channel_id = await get_channel_id(session, channel_url)
 
     url = f"https://youtube.googleapis.com/youtube/v3/channels?part=contentDetails&id={channel_id}&maxResults={max_results}&key={api_key}"
-    channel_playlist_id_response_json = api_get_request(url, exit_if_not=True).json()
+    channel_playlist_id_response_json = await cached_api_get_json(session, url, playlist_cache_ttl)
     playlist_id = channel_playlist_id_response_json["items"][0]["contentDetails"]["relatedPlaylists"]["uploads"]
 
     return playlist_id
 
 
-def fetch_channel_data(playlist_id, max_results, api_key, get_play_list_url):
+async def fetch_videos_statistics(session, videos_statistics_url, batch_videos, video_ids):
+    """
+    Adds statistics to the videos of the batch (video id -> video json), returns the batch.
+    """
 
-    url = f"{get_play_list_url}key={api_key}&playlistId={playlist_id}&part=snippet,id,contentDetails&maxResults={max_results}"
-    response_json = api_get_request(url, exit_if_not=True).json()
+    if len(video_ids) == 0:
+        return batch_videos
 
-    channel_title = None
-    if not len(response_json["items"]) == 0:
-        channel_title = response_json["items"][0]["snippet"]["channelTitle"]
-    videos_number = response_json["pageInfo"]["totalResults"]
+    # Sending a request for videos statistics data (likes, views, comments_number)
+    # print("Request statistics...")
+    videos_id_str = ",".join(video_ids)
+    videos_statistics_json = await cached_api_get_json(session, videos_statistics_url + videos_id_str, statistics_cache_ttl)
 
-    return channel_title, videos_number
+    # print("Parsing statistics...")
+    add_videos_statistics(batch_videos, videos_statistics_json["items"])
 
+    return batch_videos
 
-def get_videos_list(playlist_id, max_results, api_key, get_play_list_url, get_videos_url):
 
-    page_token = ""
-    run = True
-    videos_list = []
-    total_counter = 0
+async def get_videos_list(session, playlist_id, max_results, api_key, get_play_list_url, get_videos_url):
+    """
+    Fetches the first playlist page to get channel data (title and number of videos).
+    Returns the channel data and a generator of all videos that goes on from this page.
+    """
 
-    next_token_url_part = "&pageToken="
-    youtube_link = "https://www.youtube.com/watch?v="
-
-    while run:
-        """ 
-        Sometimes when you make too many requests server may freeze your current request.
-        You just need to wait a few seconds (5 - 15) and parsing will continue.
-        """
-
-        # print("\nRequest details...")
-        url = get_play_list_url + f"key={api_key}&playlistId={playlist_id}&part=snippet,id,contentDetails&maxResults={max_results}{page_token}"
-
-        response = api_get_request(url)
-        if response == False:
-            return videos_list
+    # Constant parts of the urls, only page token / videos ids are appended for each request
+    # ("maxResults" isn't supported together with "id" by "videos" api request)
+    playlist_page_url = f"{get_play_list_url}key={api_key}&playlistId={playlist_id}&part=snippet,id,contentDetails&maxResults={max_results}"
+    videos_statistics_url = f"{get_videos_url}key={api_key}&part=statistics&id="
 
-        json_response = response.json()
+    # print("\nRequest details...")
+    json_response = await cached_api_get_json(session, playlist_page_url, playlist_cache_ttl)
 
-        title_buffer = []
-        description_buffer = []
-        video_id_buffer = []
-        publish_time_buffer = []
+    channel_title = None
+    if not len(json_response["items"]) == 0:
+        channel_title = json_response["items"][0]["snippet"]["channelTitle"]
+    videos_number = json_response["pageInfo"]["totalResults"]
 
-        # Parsing json
-        # print("Parsing details...")
-        for item in json_response["items"]:
-            if item["kind"] == "youtube#playlistItem":
+    videos = iterate_videos(session, json_response, playlist_page_url, videos_statistics_url)
+    return channel_title, videos_number, videos
 
-                title = item["snippet"]["title"] if "title" in item["snippet"] else None
-                description = item["snippet"]["description"] if "description" in item["snippet"] else None
-                video_id = item["contentDetails"]["videoId"] if "videoId" in item["contentDetails"] else None
-                publish_time = item["snippet"]["publishedAt"].replace('T', ' ').replace('Z', '') if "publishedAt" in item["snippet"] else None
 
-                title_buffer.append(title)
-                description_buffer.append(description)
-                video_id_buffer.append(video_id)
-                publish_time_buffer.append(publish_time)
+def cancel_tasks(tasks):
+    for task in tasks:
+        if not task.cancel() and not task.cancelled():
+            # Finished task: its exception (if any) is marked as retrieved
+            task.exception()
 
-                # Logging
-                total_counter += 1
 
-        # Sending a request for videos statistics data (likes, views, comments_number)
-        # print("Request statistics...")
-        videos_id_str = ",".join(video_id_buffer)
-        videos_statistics_url = f"{get_videos_url}key={api_key}&maxResults={max_results}&part=statistics&id={videos_id_str}"
+async def iterate_videos(session, json_response, playlist_page_url, videos_statistics_url):
+    """
+    Yields videos in the playlist order as soon as their statistics arrive,
+    so the whole channel doesn't have to be kept in memory.
+    After a failed playlist page the videos parsed so far are still passed on,
+    after a failed statistics batch the rest of the videos are skipped.
+    """
 
-        videos_statistics_response = api_get_request(videos_statistics_url)
-        if videos_statistics_response == False:
-            return videos_list
-
-        videos_statistics_json = videos_statistics_response.json()
-
-        # print("Parsing statistics...")
-        for i, video in enumerate(videos_statistics_json["items"]):
+    run = True
+    pending_videos = {}
+    pending_video_ids = []
+    statistics_tasks = deque()
+    next_page_task = None
+    total_counter = 0
 
-            views = video["statistics"]["viewCount"] if "viewCount" in video["statistics"] else None
-            likes = video["statistics"]["likeCount"] if "likeCount" in video["statistics"] else None
-            comments_number = video["statistics"]["commentCount"] if "commentCount" in video["statistics"] else None
+    next_token_url_part = "&pageToken="
 
-            # Json style list formation
-            videos_list.extend([{
+    batch_statistics_task = lambda: asyncio.create_task(fetch_videos_statistics(
+        session, videos_statistics_url, pending_videos, pending_video_ids))
 
-                "title": title_buffer[i],
-                "link": f"{youtube_link}{video_id_buffer[i]}",
-                "publish_time": publish_time_buffer[i],
-                "views": views,
-                "likes": likes,
-                "comments_number": comments_number,
-                "description": description_buffer[i],
+    try:
+        while run:
+            """
+            Sometimes when you make too many requests server may freeze your current request.
+            You just need to wait a few seconds (5 - 15) and parsing will continue.
+            """
+
+            # If the json page doesn't have "nextPageToken" parameter -> it's the last page on the channel -> break
+            # Else change token in the url and request the next page, it is fetched while this page is parsed
+            if "nextPageToken" in json_response:
+                page_token = next_token_url_part + json_response["nextPageToken"]
+                next_page_task = asyncio.create_task(cached_api_get_json(session, playlist_page_url + page_token, playlist_cache_ttl))
+            else:
+                run = False
+
+            # Parsing json
+            # print("Parsing details...")
+            for key, video_id, video in parse_playlist_page(json_response["items"]):
+
+                # Statistics are added to the videos when they arrive
+                pending_videos[key] = video
+                if video_id is not None:
+                    pending_video_ids.append(video_id)
 
-            }])
+                # Logging
+                total_counter += 1
 
-        print(f"Parsed {total_counter} videos")
+                # Statistics are requested by full batches of ids (independently of the page size)
+                # in the background while the next pages are fetched
+                if len(pending_video_ids) == videos_statistics_batch_size:
+                    statistics_tasks.append(batch_statistics_task())
+                    pending_videos = {}
+                    pending_video_ids = []
+
+            print(f"Parsed {total_counter} videos")
+
+            # Passing on the batches (in order) whose statistics already arrived
+            while len(statistics_tasks) > 0 and statistics_tasks[0].done():
+                for video in statistics_tasks.popleft().result().values():
+                    yield video
+
+            if run:
+                try:
+                    json_response = await next_page_task
+                except RequestFailed as e:
+                    # No more pages, but statistics of the videos parsed so far are still requested
+                    print(f"\n{e}\n")
+                    run = False
+
+        # The last, not full batch
+        if len(pending_videos) > 0:
+            statistics_tasks.append(batch_statistics_task())
+
+        while len(statistics_tasks) > 0:
+            for video in (await statistics_tasks.popleft()).values():
+                yield video
+
+    except RequestFailed as e:
+        print(f"\n{e}\n")
+        cancel_tasks(statistics_tasks)
+        if next_page_task is not None:
+            cancel_tasks([next_page_task])
+
+
+async def save_channel_data_json(json_file_name, channel_title, videos_number, videos):
+
+    # The file is written by parts as videos arrive (instead of a single orjson.dumps of the whole channel)
+    # with the same layout: utf-8 (not escaped) text, 2 spaces indent.
+    # It goes to a temporary file that replaces the out file only when it's complete, so an error in the middle
+    # doesn't leave a truncated json (api / network errors stop the videos generator, the videos got so far are saved)
+    json_file_path = f"{json_file_name}.json"
+    tmp_file_path = f"{json_file_path}.tmp"
+    videos_indent = b"\n    "
+    try:
+        with open(tmp_file_path, "wb") as file:
+            file.write(b'{\n  "channel_title": ' + orjson.dumps(channel_title) +
+                       b',\n  "videos_number": ' + orjson.dumps(videos_number) +
+                       b',\n  "videos": [')
 
-        # If the next json page doesn't have "nextPageToken" parameter -> parsed all videos on the channel -> break
-        # Else change token in the url and continue making requests to the api
-        if "nextPageToken" in json_response:
-            page_token = next_token_url_part + json_response["nextPageToken"]
-        else:
-            run = False
+            separator = videos_indent
+            async for video in videos:
+                file.write(separator + orjson.dumps(video, option=orjson.OPT_INDENT_2).replace(b"\n", videos_indent))
+                separator = b"," + videos_indent
 
-    return videos_list
+            file.write(b"]\n}" if separator == videos_indent else b"\n  ]\n}")
+        os.replace(tmp_file_path, json_file_path)
+    finally:
+        if os.path.exists(tmp_file_path):
+            os.remove(tmp_file_path)
 
 
 def correct_args(args):
@@ -199,27 +334,22 @@ def correct_args(args):
 
 
 def get_args():
-    global default_out_file_path, default_max_results
-
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-url", help="Channel link")
-    parser.add_argument("-key", help="Your youtube api key")
-    parser.add_argument("-out", help=f"Path to the out json file, default: '{default_out_file_path}.json'",
-                        default=default_out_file_path)
-    parser.add_argument("-maxr", help=f"Max results per request, default: {default_max_results}, it's apis maximum",
-                        default=default_max_results)
+
     args = parser.parse_args(sys.argv[1:])
 
     print("\nArguments validation...")
     return correct_args(args)
 
 
-def validate_args(args):
+async def validate_args(session, args):
 
     error_m = ""
-    url_resp = stubborn_request(args.url)
-    api_resp = stubborn_request(
-            f"https://youtube.googleapis.com/youtube/v3/channels?part=contentDetails&id=UCK8sQmJBp8GCxrOtXWBpyEA&maxResults=50&key={args.key}")
+    # Both requests are independent, so they are sent at the same time
+    url_resp, api_resp = await asyncio.gather(
+        stubborn_request(session, args.url),
+        stubborn_request(
+            session,
+            f"https://youtube.googleapis.com/youtube/v3/channels?part=contentDetails&id=UCK8sQmJBp8GCxrOtXWBpyEA&maxResults=50&key={args.key}"))
 
     # Http errors validation
     if url_resp.status_code == 404:
@@ -233,55 +363,72 @@ def validate_args(args):
         error_m += f"Error: api response error!\n"
 
     # Arguments errors validation
-    os_can_save = lambda file_name: len([True for s in '\/:*?"<>|' if s in file_name]) == 0
-    if not os_can_save(args.out):
+    if forbidden_file_name_re.search(args.out):
         error_m += 'Error: file name can not contain \/:*?"<>| symbols!\n'
 
     return error_m
 
 
-def main():
+async def main():
+    global api_cache, request_semaphore
 
     args = get_args()
-    validation_error = validate_args(args)
-    if validation_error != "":
-        print(validation_error)
-        return
-
-    # Your values
-    channel_url = args.url
-    json_file_name = args.out
-    max_results = int(args.maxr)  # youtube api v3 can return from 0 to 50 results per 1 page
-    api_key = args.key
-
-    # Api url to get playlist items (videos)
-    get_playlist_url = "https://www.googleapis.com/youtube/v3/playlistItems?"
 
-    # Api url to get videos by id
-    get_videos_url = "https://www.googleapis.com/youtube/v3/videos?"
+    if args.clear_cache:
+        with Cache(cache_dir) as cache:
+            cache.clear()
+    if not args.no_cache:
+        api_cache = Cache(cache_dir)
+    request_semaphore = asyncio.Semaphore(max_concurrent_requests)
 
-    print("\nFetching channel id & playlist id...")
-    # Fetching channel playlist id
-    playlist_id = fetch_channel_playlist_id(channel_url, max_results, api_key)
-
-    print("Fetching channel data...")
-    # Fetching channel data (title and number of videos)
-    channel_title, videos_number = fetch_channel_data(playlist_id, max_results, api_key, get_playlist_url)
-
-    # Fetch all videos from channel (channel playlist)
-    videos_list = get_videos_list(playlist_id, max_results, api_key, get_playlist_url, get_videos_url)
-
-    channel_data_json = {
-        "channel_title": channel_title,
-        "videos_number": videos_number,
-        "videos": videos_list
-    }
-
-    # Saving json to the file
-    print("\nSaving json file...")
-    with open(f"{json_file_name}.json", "w", encoding="utf-8") as file:
-        json.dump(channel_data_json, file, indent=4, ensure_ascii=False)
+    try:
+        # One session for the whole run: with HTTP/2 concurrent requests share one TCP + TLS connection as streams,
+        # connections are reused via keep-alive
+        limits = httpx.Limits(max_connections=connection_pool_size, max_keepalive_connections=connection_pool_size)
+        # Brotli compressed responses are smaller than gzip ones (httpx decodes them with Brotli package)
+        headers = {"Accept-Encoding": "br, gzip"}
+        async with httpx.AsyncClient(http2=True, limits=limits, timeout=request_timeout, headers=headers) as session:
+
+            validation_error = await validate_args(session, args)
+            if validation_error != "":
+                print(validation_error)
+                return
+
+            # Your values
+            channel_url = args.url
+            json_file_name = args.out
+            max_results = int(args.maxr)  # youtube api v3 can return from 0 to 50 results per 1 page
+            api_key = args.key
+
+            # Api url to get playlist items (videos)
+            get_playlist_url = "https://www.googleapis.com/youtube/v3/playlistItems?"
+
+            # Api url to get videos by id
+            get_videos_url = "https://www.googleapis.com/youtube/v3/videos?"
+
+            print("\nFetching channel id & playlist id...")
+            # Fetching channel playlist id
+            playlist_id = await fetch_channel_playlist_id(session, channel_url, max_results, api_key)
+
+            print("Fetching channel data...")
+            # Fetching channel data (title and number of videos) from the first page of the channel playlist
+            channel_title, videos_number, videos = await get_videos_list(
+                session, playlist_id, max_results, api_key, get_playlist_url, get_videos_url)
+
+            # Fetch all videos from channel (channel playlist) and save them to the file on the go
+            print("\nFetching videos & saving json file...")
+            await save_channel_data_json(json_file_name, channel_title, videos_number, videos)
+
+    finally:
+        # Closed on every run, so main() can be called several times
+        if api_cache is not None:
+            api_cache.close()
+            api_cache = None
+        request_semaphore = None
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        asyncio.run(main())
+    except RequestFailed as e:
+        sys.exit(f"error: {e}")
@@ -0,0 +1,64 @@
+from typing import Any, Dict, List, Optional, Tuple
+
+"""
+Parsing of the api json pages: the cpu bound part of the run (a few dict lookups per video).
+
+The module is plain typed python, so it can be compiled with mypyc for speed:
+    pip install mypy && mypyc videos_parser.py
+The compiled .so module is imported instead of this file when it exists next to it,
+without it this file is used as is.
+"""
+
+youtube_link = "https://www.youtube.com/watch?v="
+
+
+def parse_playlist_page(items: List[Dict[str, Any]]) -> List[Tuple[str, Optional[str], Dict[str, Any]]]:
+    """
+    Returns (key, video id, video json) for each video of the "playlistItems" page.
+    The key is the video id, or the (unique) playlist item id for a video without id.
+    Statistics fields are None until statistics are added.
+    """
+
+    videos: List[Tuple[str, Optional[str], Dict[str, Any]]] = []
+
+    for item in items:
+        if item["kind"] == "youtube#playlistItem":
+
+            snippet: Dict[str, Any] = item.get("snippet") or {}
+            title: Optional[str] = snippet.get("title")
+            description: Optional[str] = snippet.get("description")
+            video_id: Optional[str] = (item.get("contentDetails") or {}).get("videoId")
+            # "2023-01-02T03:04:05Z" -> "2023-01-02 03:04:05"
+            published_at: Optional[str] = snippet.get("publishedAt")
+            publish_time = published_at[:10] + " " + published_at[11:19] if published_at is not None else None
+
+            # Json style video formation
+            video = {
+
+                "title": title,
+                "link": f"{youtube_link}{video_id}",
+                "publish_time": publish_time,
+                "views": None,
+                "likes": None,
+                "comments_number": None,
+                "description": description,
+
+            }
+            videos.append((video_id if video_id is not None else item["id"], video_id, video))
+
+    return videos
+
+
+def add_videos_statistics(batch_videos: Dict[str, Dict[str, Any]], items: List[Dict[str, Any]]) -> None:
+    """
+    Adds statistics of the "videos" page to the videos of the batch (video id -> video json).
+    """
+
+    # Api may return fewer items than requested, so statistics are matched to videos by id, not by position
+    for video in items:
+
+        statistics: Dict[str, Any] = video.get("statistics") or {}
+        batch_video = batch_videos[video["id"]]
+        batch_video["views"] = statistics.get("viewCount")
+        batch_video["likes"] = statistics.get("likeCount")
+        batch_video["comments_number"] = statistics.get("commentCount")